@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
-import copy
+import functools
+import itertools
 import json
 import logging
+import operator
+import os
 import shutil
 import tempfile
-from collections import defaultdict
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 JSONType = dict[str, dict | list] | list[dict[str, dict | list]]
 MainConfigType = JSONType
 CustomConfigType = list[dict[str, dict | list]]
@@ -17,14 +24,20 @@ OrderingDataType = list[str]
 
 LOG_FILE_NAME = "compile_config_json.log"
 PUBLII_THEME_ROOT_MARKER = ".publii_theme_root"
+MODULE_PATH = Path(__file__).resolve()
+TMP_DIR_PREFIX = ".merge_config_"
 
 logger = logging.getLogger("__name__")
 
 
-class SortingGroupDoesNotExist(Exception):
-    def __init__(self, group_name: str, *args):
-        self.group_name = group_name
-        super().__init__(*args)
+class LazyJson:
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: JSONType):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj, indent=4, ensure_ascii=False)
 
 
 def setup_logging() -> None:
@@ -39,107 +52,99 @@ def setup_logging() -> None:
     logger.addHandler(ch)
 
 
-@dataclass
-class GroupOrderingDataItem:
-    first_item_index: int | None = None
-    last_item_index: int | None = None
+@functools.lru_cache(maxsize=1)
+def get_theme_root() -> Path:
+    for candidate in (MODULE_PATH, *MODULE_PATH.parents):
+        cfg = candidate / PUBLII_THEME_ROOT_MARKER
+        if cfg.is_file():
+            logger.info("Theme root: %s", candidate)
+            return candidate
+    raise FileNotFoundError(
+        "Unable to locate theme root (expected a '.publii_theme_root' file in some parent)."
+    )
+
+
+class NonFiniteFloat(float):
+    # orjson refuses float subclasses, so dump_json() writes NaN and Infinity
+    # with json instead of letting orjson turn them into null.
+    pass
 
-    @property
-    def is_found(self):
-        return self.first_item_index is not None and self.last_item_index is not None
+
+def load_json(path: Path) -> JSONType:
+    # orjson would read integers wider than 64 bits as floats and rejects NaN,
+    # so files are always parsed with json.
+    return json.loads(path.read_bytes(), parse_constant=NonFiniteFloat)
+
+
+def dump_json(obj: JSONType) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+def group_custom_config(
+    custom_config: CustomConfigType,
+) -> dict[str, CustomConfigType]:
+    groups: dict[str, CustomConfigType] = {}
+    # Objects of a group are usually contiguous, so extend by runs. A group can
+    # still be split, e.g. across files when order.json is missing.
+    try:
+        for group_name, group_run in itertools.groupby(
+            custom_config, key=operator.itemgetter("group")
+        ):
+            groups.setdefault(group_name, []).extend(group_run)
+    except KeyError:
+        data_obj = next(
+            data_obj for data_obj in custom_config if "group" not in data_obj
+        )
+        logger.error(
+            "Malformed custom config object - 'group' key is missing:\n%s",
+            LazyJson(data_obj),
+        )
+        raise
+    return groups
 
 
 class CustomConfigSorter:
     def __init__(
         self, custom_config: CustomConfigType, ordering_data: OrderingDataType
     ):
-        self._custom_config = copy.deepcopy(custom_config)
+        self._custom_config = custom_config
         self._ordering_data = ordering_data
 
-    def get_sorted_custom_config(self) -> CustomConfigType:
-        missing_groups = set()
-        for group_name_1, group_name_2 in zip(
-            self._ordering_data, self._ordering_data[1:]
-        ):
-            try:
-                group_2 = self._pop_group_2(group_name_2=group_name_2)
-                self._insert_group_2_after_group_1(
-                    group_name_1=group_name_1, group_2=group_2
-                )
-            except SortingGroupDoesNotExist as e:
-                missing_groups.add(e.group_name)
-        sorted_groups = set(self._ordering_data).difference(missing_groups)
-        sorted_groups = [
-            group_name
-            for group_name in self._ordering_data
-            if group_name in sorted_groups
-        ]
-        logger.info("Sorted custom config groups: %s", ", ".join(sorted_groups))
-        return self._custom_config
-
-    def _pop_group_2(self, group_name_2: str) -> CustomConfigType:
-        group_ordering_data_item_2 = self._collect_group_ordering_data_item(
-            group_name=group_name_2
+    def get_sorted_custom_config_groups(self) -> dict[str, CustomConfigType]:
+        groups = group_custom_config(self._custom_config)
+        missing_groups = set(self._ordering_data).difference(groups)
+        for group_name in self._ordering_data:
+            if group_name in missing_groups:
+                logger.warning("Group '%s' is not found in custom config", group_name)
+        # order.json is edited by hand and may list a group more than once.
+        sorted_groups = list(
+            dict.fromkeys(
+                group_name
+                for group_name in self._ordering_data
+                if group_name not in missing_groups
+            )
         )
 
-        before_group_2 = self._custom_config[
-            : group_ordering_data_item_2.first_item_index
-        ]
-        group_2 = self._custom_config[
-            group_ordering_data_item_2.first_item_index : group_ordering_data_item_2.last_item_index
-            + 1
-        ]
-        after_group_2 = self._custom_config[
-            group_ordering_data_item_2.last_item_index + 1 :
-        ]
-        self._custom_config = before_group_2 + after_group_2
-        return group_2
-
-    def _insert_group_2_after_group_1(
-        self, group_name_1: str, group_2: CustomConfigType
-    ) -> None:
-        group_ordering_data_item_1 = self._collect_group_ordering_data_item(
-            group_name=group_name_1
-        )
-        before_group_2 = self._custom_config[
-            : group_ordering_data_item_1.last_item_index + 1
-        ]
-        after_group_2 = self._custom_config[
-            group_ordering_data_item_1.last_item_index + 1 :
-        ]
-        self._custom_config = before_group_2 + group_2 + after_group_2
-
-    def _collect_group_ordering_data_item(
-        self, group_name: str
-    ) -> GroupOrderingDataItem:
-        group_ordering_data_item = GroupOrderingDataItem()
-        for i, data_obj in enumerate(self._custom_config):
-            try:
-                data_obj_group = data_obj["group"]
-            except KeyError:
-                logger.error(
-                    "Malformed custom config object - 'group' key is missing:\n%s",
-                    json.dumps(data_obj, indent=4, ensure_ascii=False),
-                )
-                raise
-            if (
-                group_ordering_data_item.first_item_index is None
-                and data_obj_group == group_name
-            ):
-                group_ordering_data_item.first_item_index = i
-            if data_obj_group == group_name:
-                group_ordering_data_item.last_item_index = i
-        if not group_ordering_data_item.is_found:
-            logger.warning("Group '%s' is not found in custom config", group_name)
-            raise SortingGroupDoesNotExist(group_name=group_name)
-        return group_ordering_data_item
+        group_order = list(groups)
+        for group_name_1, group_name_2 in zip(sorted_groups, sorted_groups[1:]):
+            group_order.remove(group_name_2)
+            group_order.insert(group_order.index(group_name_1) + 1, group_name_2)
+
+        logger.info("Sorted custom config groups: %s", ", ".join(sorted_groups))
+        return {group_name: groups[group_name] for group_name in group_order}
 
 
 class JsonCompiler:
     _ORDERING_KEYS = ["place_before", "place_after"]
+    _MAX_IO_WORKERS = 16
 
     def __init__(self) -> None:
-        self._root_dir = self._get_theme_root()
+        self._root_dir = get_theme_root()
         self._config_dir = self._root_dir / "config"
         self._custom_config_dir = self._config_dir / "custom"
         self._custom_config_groups_dir = self._custom_config_dir / "groups"
@@ -151,6 +156,7 @@ class JsonCompiler:
         self._ordering_data: OrderingDataType = []
         self._main_config: MainConfigType = {}
         self._custom_config: CustomConfigType = []
+        self._custom_config_groups: dict[str, CustomConfigType] = {}
 
     def run(self) -> None:
         self._load_main_config()
@@ -160,25 +166,12 @@ class JsonCompiler:
         config = self._get_joined_main_and_custom_config()
         self._replace_config_in_root(config)
 
-    @staticmethod
-    def _get_theme_root() -> Path:
-        cwd = Path(__file__).resolve()
-        for candidate in [cwd] + list(cwd.parents):
-            cfg = candidate / PUBLII_THEME_ROOT_MARKER
-            if cfg.is_file():
-                logger.info("Theme root: %s", candidate)
-                return candidate
-        raise FileNotFoundError(
-            "Unable to locate theme root (expected a '.publii_theme_root' file in some parent)."
-        )
-
     def _load_main_config(self) -> None:
         if not self._main_config_file_path.is_file():
             raise FileNotFoundError(
                 f"Missing main config: {self._main_config_file_path}"
             )
-        with self._main_config_file_path.open("r") as fh:
-            self._main_config = json.load(fh)
+        self._main_config = load_json(self._main_config_file_path)
         if not isinstance(self._main_config, dict):
             raise TypeError(
                 f"JSON in config/custom_main.json must be an object (dict), got {type(self._main_config).__name__}"
@@ -197,9 +190,11 @@ class JsonCompiler:
             logger.info("No custom JSON files in: %s", self._custom_config_groups_dir)
             return
 
-        for file in custom_config_files:
-            with file.open("r") as fh:
-                data: CustomConfigType = json.load(fh)
+        with ThreadPoolExecutor(
+            max_workers=min(self._MAX_IO_WORKERS, len(custom_config_files))
+        ) as executor:
+            custom_config_data = list(executor.map(load_json, custom_config_files))
+        for file, data in zip(custom_config_files, custom_config_data):
             if not isinstance(data, list):
                 raise TypeError(
                     f"JSON in custom config {file} must be an array (list), got {type(data).__name__}"
@@ -214,42 +209,55 @@ class JsonCompiler:
                 self._group_order_file_path,
             )
             return
-        with self._group_order_file_path.open("r") as fh:
-            self._ordering_data: OrderingDataType = json.load(fh)
+        self._ordering_data: OrderingDataType = load_json(self._group_order_file_path)
         if len(self._ordering_data) == 0:
             logger.info("Group order json is empty (skipping)")
             return
         if len(self._ordering_data) < 2:
             raise ValueError("Group order json must have at least 2 group names")
 
-        self._custom_config = CustomConfigSorter(
+        self._custom_config_groups = CustomConfigSorter(
             custom_config=self._custom_config, ordering_data=self._ordering_data
-        ).get_sorted_custom_config()
+        ).get_sorted_custom_config_groups()
+        self._custom_config = list(
+            itertools.chain.from_iterable(self._custom_config_groups.values())
+        )
 
     def _recreate_custom_config_files(self):
-        groups = defaultdict(list)
-        for config_obj in self._custom_config:
-            groups[config_obj["group"]].append(config_obj)
+        # Reuse the sorter's groups, group here only if sorting was skipped.
+        groups = self._custom_config_groups or group_custom_config(
+            self._custom_config
+        )
+        group_payloads = {
+            f"{group_name}.json": dump_json(group_obj)
+            for group_name, group_obj in groups.items()
+        }
+        group_order_payload = dump_json(list(groups))
+        if self._is_custom_config_unchanged(group_payloads, group_order_payload):
+            logger.info("Custom config files are up to date (skipping)")
+            return
 
-        with tempfile.TemporaryDirectory() as tmp_dir:
+        with tempfile.TemporaryDirectory(
+            prefix=TMP_DIR_PREFIX, dir=self._custom_config_dir
+        ) as tmp_dir:
             groups_tmp_dir = Path(tmp_dir) / "groups"
             groups_tmp_dir.mkdir()
             group_order_tmp_dir = Path(tmp_dir) / "group_order"
             group_order_tmp_dir.mkdir()
             group_order_file_path = group_order_tmp_dir / "order.json"
-            for group_name, group_obj in groups.items():
-                group_file = groups_tmp_dir / f"{group_name}.json"
-                with group_file.open("w") as fh:
-                    json.dump(group_obj, fh, indent=4, ensure_ascii=False)  # type: ignore
-            with group_order_file_path.open("w") as fh:
-                json.dump(list(groups), fh, indent=4, ensure_ascii=False)  # type: ignore
-
-            if (
-                len(removed_groups := set(self._ordering_data).difference(list(groups)))
-                > 0
-            ):
+            payloads = {
+                groups_tmp_dir / file_name: payload
+                for file_name, payload in group_payloads.items()
+            }
+            payloads[group_order_file_path] = group_order_payload
+            with ThreadPoolExecutor(
+                max_workers=min(self._MAX_IO_WORKERS, len(payloads))
+            ) as executor:
+                list(executor.map(Path.write_bytes, payloads, payloads.values()))
+
+            if removed_groups := set(self._ordering_data).difference(groups):
                 logger.info("Removed groups: %s", ", ".join(removed_groups))
-            if len(new_groups := set(list(groups)).difference(self._ordering_data)) > 0:
+            if new_groups := set(groups).difference(self._ordering_data):
                 logger.info("New groups: %s", ", ".join(new_groups))
 
             backup_dir = Path(tmp_dir) / "backup"
@@ -258,43 +266,62 @@ class JsonCompiler:
             backup_group_order_tmp_dir = Path(backup_dir) / "group_order"
             backup_group_order_tmp_dir.mkdir()
             backup_group_order_file_path = backup_group_order_tmp_dir / "order.json"
-            shutil.copy(self._group_order_file_path, backup_group_order_file_path)
-            shutil.copytree(self._custom_config_groups_dir, backup_groups_tmp_dir)
-
             try:
-                shutil.copy(group_order_file_path, self._group_order_file_path)
-                if self._custom_config_groups_dir.exists():
-                    shutil.rmtree(self._custom_config_groups_dir)
-                shutil.copytree(groups_tmp_dir, self._custom_config_groups_dir)
+                os.link(self._group_order_file_path, backup_group_order_file_path)
+            except OSError:
+                shutil.copy2(self._group_order_file_path, backup_group_order_file_path)
+
+            # The temporary directory is on the same filesystem as the custom
+            # config, so files are swapped in with a rename and shutil.move()
+            # does not have to copy the groups directory. Replacing order.json
+            # instead of writing into it also keeps its hard-linked backup intact.
+            groups_backed_up = False
+            try:
+                os.replace(group_order_file_path, self._group_order_file_path)
+                shutil.move(self._custom_config_groups_dir, backup_groups_tmp_dir)
+                groups_backed_up = True
+                shutil.move(groups_tmp_dir, self._custom_config_groups_dir)
             except Exception:
                 logger.error(
                     "Some exception occurred, during recreating custom config files. Restoring custom config files from backup..."
                 )
-                shutil.copy(backup_group_order_file_path, self._group_order_file_path)
-                if self._custom_config_groups_dir.exists():
-                    shutil.rmtree(self._custom_config_groups_dir)
-                shutil.copytree(backup_groups_tmp_dir, self._custom_config_groups_dir)
+                os.replace(backup_group_order_file_path, self._group_order_file_path)
+                if groups_backed_up:
+                    if self._custom_config_groups_dir.exists():
+                        shutil.rmtree(self._custom_config_groups_dir)
+                    shutil.move(backup_groups_tmp_dir, self._custom_config_groups_dir)
                 raise
 
         logger.info(
             "Recreated config/custom/groups and config/custom/group_order/order.json with fresh data"
         )
 
+    def _is_custom_config_unchanged(
+        self, group_payloads: dict[str, bytes], group_order_payload: bytes
+    ) -> bool:
+        if (
+            not self._group_order_file_path.is_file()
+            or self._group_order_file_path.read_bytes() != group_order_payload
+        ):
+            return False
+        if not self._custom_config_groups_dir.is_dir():
+            return False
+        group_files = {
+            path.name: path for path in self._custom_config_groups_dir.iterdir()
+        }
+        if group_files.keys() != group_payloads.keys():
+            return False
+        return all(
+            group_files[file_name].read_bytes() == payload
+            for file_name, payload in group_payloads.items()
+        )
+
     def _get_joined_main_and_custom_config(self) -> JSONType:
-        merged = copy.deepcopy(self._main_config)
-        merged["customConfig"] = self._custom_config
-        return merged
+        return {**self._main_config, "customConfig": self._custom_config}
 
     def _replace_config_in_root(self, config: JSONType) -> None:
         out_path = self._root_dir / "config.json"
-        with out_path.open("w", encoding="utf-8") as fh:
-            json.dump(
-                config,
-                fh,  # type: ignore
-                ensure_ascii=True,
-                indent=4,
-            )
-            fh.write("\n")
+        out_path.write_bytes(dump_json(config) + b"\n")
         logger.info("Wrote merged config to: %s", out_path)
 
 